@@ -15,11 +15,3 @@ from __future__ import (
 
 from .asdf_data_set import CloudASDFDataSet
 from .exceptions import ASDFDictNotInFileError, AWSCredentialError
-
-import os
-
-cred = os.environ["HOME"] + "/.aws/credentials"
-if os.path.exists(cred):
-    print("AWS credential exists.")
-else:
-    raise AWSCredentialError("\nCheck credentials.\nSearching at %s" % cred)
@@ -6,26 +6,62 @@
 # License
 #    MIT License
 
-try:
-    import srpybin as sliderule
-except:
-    print("Check sliderule python-binding as it is not imported.")
-
+import hashlib
 import numpy as np
 import h5py
 import obspy
-import datetime
 import io
+import os
+import pickle
+import tempfile
 
 from .utils import (
     readp_array,
-    parse_trace,
     read_dict,
+    _string_view,
+    _build_trace,
+    H5pyFile,
+    CachedH5Coro,
     StationAccessor,
     AuxiliaryDataGroupAccessor,
 )
 
-from .exceptions import CloudASDFValueError, ASDFDictNotInFileError
+from .exceptions import (
+    CloudASDFValueError,
+    ASDFDictNotInFileError,
+    AWSCredentialError,
+)
+
+_sliderule = None
+_has_aws_credentials = False
+
+
+def _get_sliderule():
+    """
+    Import the sliderule python-binding on first use, so that importing
+    CloudPyASDF for local files does not pay for it.
+    """
+    global _sliderule
+    if _sliderule is None:
+        try:
+            import srpybin as _sliderule
+        except ImportError:
+            raise ImportError("Check sliderule python-binding as it is not imported.")
+    return _sliderule
+
+
+def _check_aws_credentials():
+    """
+    Check that AWS credentials exist before reading from S3. The check is
+    only done once per process.
+    """
+    global _has_aws_credentials
+    if _has_aws_credentials:
+        return
+    cred = os.path.join(os.path.expanduser("~"), ".aws", "credentials")
+    if not os.path.exists(cred):
+        raise AWSCredentialError("\nCheck credentials.\nSearching at %s" % cred)
+    _has_aws_credentials = True
 
 
 class CloudASDFDataSet(object):
@@ -38,6 +74,9 @@ class CloudASDFDataSet(object):
         endpoint="https://s3.us-west-2.amazonaws.com",
         asdfdict_path="/AuxiliaryData/ASDFDict",
         ASDFDict=None,
+        rdcc_nbytes=64 * 1024**2,
+        rdcc_nslots=10007,
+        cache_dir=None,
     ):
         """
         Initialization class
@@ -48,9 +87,14 @@ class CloudASDFDataSet(object):
             path (str): file name path
             region (str): for s3 bucket region
             endpoint (str): for s3 endpoint
+            rdcc_nbytes (int): chunk cache size in bytes for local files
+            rdcc_nslots (int): chunk cache hash table slots for local files
+            cache_dir (str): directory, e.g. "~/.cache/cloudpyasdf", where
+                parsed StationXML and QuakeML objects are pickled so that
+                later opens skip the ObsPy parser. Disabled if None.
 
         Returns:
-            h5file (sliderule.h5coro): h5coro file object
+            h5file (sliderule.h5coro or H5pyFile): file object
 
         Examples:
             >>> h5file = sliderule.h5coro("asdf.h5", "s3", "seisbasin/ASDF/", "us-west-2", "https://s3.us-west-2.amazonaws.com")
@@ -61,10 +105,25 @@ class CloudASDFDataSet(object):
         self.path = path
         self.region = region
         self.endpoint = endpoint
+        self.cache_dir = cache_dir
 
-        self._file = sliderule.h5coro(
-            self.resource, self.format, self.path, self.region, self.endpoint
-        )
+        if self.format == "file":
+            # Local files are read with h5py and a tuned chunk cache.
+            self._file = H5pyFile(
+                os.path.join(self.path, self.resource),
+                rdcc_nbytes=rdcc_nbytes,
+                rdcc_nslots=rdcc_nslots,
+            )
+        else:
+            _check_aws_credentials()
+            sliderule = _get_sliderule()
+            self._file = sliderule.h5coro(
+                self.resource, self.format, self.path, self.region, self.endpoint
+            )
+        # Repeated reads of the metadata (StationXML, QuakeML and ASDFDict)
+        # are served from memory, and concurrent identical reads are
+        # coalesced. Waveforms are always read from the file.
+        self._metadata_file = CachedH5Coro(self._file)
 
         if ASDFDict is not None:
             self.ASDFDict = ASDFDict
@@ -77,14 +136,44 @@ class CloudASDFDataSet(object):
                     "ASDF dictionary error. Please check asdf dict path.\n%s"
                     % asdfdict_path
                 )
-        self.waveforms = StationAccessor(self)
-        self.auxiliary_data = AuxiliaryDataGroupAccessor(self)
-
         if "QuakeML" not in self.ASDFDict.keys():
             self.events = obspy.core.event.Catalog()
         else:
             self.events = self.read_events()
 
+        self.waveforms = StationAccessor(self)
+        self.auxiliary_data = AuxiliaryDataGroupAccessor(self)
+
+    def close(self):
+        """
+        Close the underlying file object. For local files this releases the
+        h5py handle, which otherwise keeps the file from being opened for
+        writing, e.g. by CloudPyASDF.utils.dump_dict.
+
+        Examples:
+            >>> with CloudASDFDataSet("asdf.h5", "file", "./") as ds:
+            ...     print(ds)
+        """
+        _metadata_file = self.__dict__.pop("_metadata_file", None)
+        if _metadata_file is not None:
+            _metadata_file.close()
+        # sliderule.h5coro objects have nothing to close.
+        _close = getattr(self.__dict__.pop("_file", None), "close", None)
+        if _close is not None:
+            _close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
     def read_trace(self, dataset):
         """
         Read waveforms from h5file into ObsPy Traces.
@@ -96,68 +185,140 @@ class CloudASDFDataSet(object):
             >>> CloudASDFDataSet.read_trace("/Waveforms/UW.OSD/UW.OSD..EHZ__2021-01-01T00:00:00__2021-01-01T00:10:00__raw_recording")
             UW.OSD..EHZ | 2021-01-01T00:00:00.000000Z - 2021-01-01T00:10:00.000000Z | 100.0 Hz, 60001 samples
         """
-        _j = dataset.split("/")[-1]
-        _i = _j.split(".")
         _waveform = self._file.read(dataset, 0, 0, -1)
-        _tr = obspy.Trace(data=np.array(_waveform))
+        return _build_trace(dataset, _waveform, **self._waveform_info(dataset))
 
-        try:
-            starttime = datetime.datetime.strptime(
-                dataset.split("__")[1][:26], "%Y-%m-%dT%H:%M:%S.%f"
-            )
-            endtime = datetime.datetime.strptime(
-                dataset.split("__")[2][:26], "%Y-%m-%dT%H:%M:%S.%f"
-            )
-        except:
-            starttime = datetime.datetime.strptime(
-                dataset.split("__")[1], "%Y-%m-%dT%H:%M:%S"
-            )
-            endtime = datetime.datetime.strptime(
-                dataset.split("__")[2], "%Y-%m-%dT%H:%M:%S"
-            )
-        delta = (endtime - starttime).total_seconds()
-        sampling_rate = (len(_tr.data) - 1) / delta
+    def _waveform_info(self, dataset):
+        """
+        Get the dtype and sampling rate of a waveform from the ASDF
+        dictionary, if they were recorded when it was dumped.
+        """
+        _, _, station, name = dataset.split("/", 3)
+        info = self.ASDFDict["Waveforms"].get(station, {}).get(name)
+        if not isinstance(info, dict):
+            return {}
+        return {"dtype": info["dtype"], "sampling_rate": info["sampling_rate"]}
 
-        setattr(_tr.stats, "starttime", starttime)
-        setattr(_tr.stats, "sampling_rate", sampling_rate)
-        setattr(_tr.stats, "network", _i[0])
-        setattr(_tr.stats, "station", _i[1])
-        setattr(_tr.stats, "location", _i[2])
-        setattr(_tr.stats, "channel", _i[3][:3])
+    def readp_trace(self, datasets):
+        """
+        Read multiple waveforms from h5file into an ObsPy Stream. All
+        datasets are fetched with a single parallel h5coro readp call.
 
-        return _tr
+        Args:
+            datasets (list): paths to waveform data
+        """
+        readlist = [[_d, 0, 0, -1] for _d in datasets]
+        stream_data = readp_array(self._file, readlist)
 
-    def readp_trace(self, datasets):
-        readlist = []
         S = obspy.Stream()
         for _d in datasets:
-            readlist.append([_d, 0, 0, -1])
-        stream_data = readp_array(self._file, readlist)
-        for k, d in stream_data.items():
-            S.append(parse_trace(k.split("/")[3], d))
+            t = _build_trace(_d, stream_data[_d], **self._waveform_info(_d))
+            t.stats.tag = _d.rsplit("__", 1)[-1]
+            S.append(t)
         return S
 
-    def read_events(self):
-        """ """
+    def read_events(self, raw=False, size_hint=None):
+        """
+        Read the QuakeML of the file.
+
+        Args:
+            raw (bool): return the QuakeML bytes without parsing them
+            size_hint (int): only read the first size_hint bytes, see
+                read_stationxml
+        """
         # We do a serial read to the EventXML object ...
-        eventxml = self._file.read("/QuakeML", 0, 0, -1)
+        eventxml = self._read_xml("/QuakeML", size_hint)
+        if raw:
+            return eventxml.tobytes()
 
-        # ... and convert them into ObsPy StationXML object.
-        eventxml = np.array(eventxml, dtype="int8")
-        eventxml = eventxml[()].tobytes().strip()
-        return obspy.read_events(io.BytesIO(eventxml), format="quakeml")
+        # ... and convert them into ObsPy Catalog object.
+        try:
+            return self._parse_xml(eventxml, _parse_quakeml)
+        except Exception:
+            if size_hint is None:
+                raise
+            # The bounded read cut the document short.
+            eventxml = self._read_xml("/QuakeML")
+            return self._parse_xml(eventxml, _parse_quakeml)
+
+    def read_stationxml(self, dataset, raw=False, size_hint=None):
+        """
+        Read a StationXML of the file.
 
-    def read_stationxml(self, dataset, raw=False):
+        Args:
+            dataset (str): path to the StationXML dataset
+            raw (bool): return the StationXML bytes without parsing them
+            size_hint (int): only read the first size_hint bytes. With raw,
+                this probes the head of the document. Otherwise the full
+                document is read only if the bounded one fails to parse.
+        """
         # We do a serial read to the StationXML object of UW.OSD object...
-        stationxml = self._file.read(dataset, 0, 0, -1)
+        stationxml = self._read_xml(dataset, size_hint)
+        if raw:
+            return stationxml.tobytes()
 
         # ... and convert them into ObsPy StationXML object.
-        stationxml = np.array(stationxml, dtype="int8")
-        stationxml = stationxml[()].tobytes().strip()
-        if raw:
-            return stationxml
+        try:
+            return self._parse_xml(stationxml, _parse_stationxml)
+        except Exception:
+            if size_hint is None:
+                raise
+            # The bounded read cut the document short.
+            stationxml = self._read_xml(dataset)
+            return self._parse_xml(stationxml, _parse_stationxml)
+
+    def _parse_xml(self, xml, parser):
+        """
+        Parse a XML blob, going through the on-disk cache if cache_dir is set.
+
+        Cache entries are keyed on the SHA1 of the blob itself, so a changed
+        document never hits a stale entry.
+
+        Args:
+            xml (bytes-like): StationXML or QuakeML blob
+            parser (function): function turning the blob into an ObsPy object
+        """
+        if self.cache_dir is None:
+            return parser(xml)
+
+        cache_dir = os.path.expanduser(self.cache_dir)
+        filename = os.path.join(cache_dir, hashlib.sha1(xml).hexdigest() + ".pkl")
+        # The cache is best effort: unreadable entries, e.g. pickled by
+        # another ObsPy version, are misses, and a failed write does not keep
+        # the file from opening.
+        try:
+            with open(filename, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+
+        obj = parser(xml)
+
+        # Write to a temporary file first so that concurrent readers never
+        # see a partial pickle.
+        tmpname = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+                tmpname = f.name
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, filename)
+        except Exception:
+            # OSError, pickle.PickleError, or AttributeError and TypeError
+            # for objects that cannot be pickled.
+            if tmpname is not None:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+        return obj
+
+    def _read_xml(self, dataset, size_hint=None):
+        if size_hint is None:
+            _xml = self._metadata_file.read(dataset, 0, 0, -1)
         else:
-            return obspy.read_inventory(io.BytesIO(stationxml), format="stationxml")
+            _xml = self._metadata_file.read(dataset, 0, 0, size_hint)
+        return _string_view(_xml)
 
     def read_asdfdict(self, path="/AuxiliaryData/ASDFDict"):
         """
@@ -170,7 +331,7 @@ class CloudASDFDataSet(object):
             dict: ASDF dictionary object that describe H5 structure.
         """
         try:
-            asdfdict = read_dict(self._file, path)[""]
+            asdfdict = read_dict(self._metadata_file, path)[""]
             self.ASDFDict = asdfdict
 
         except:
@@ -240,13 +401,33 @@ class CloudASDFDataSet(object):
         p.text(self.__str__())
 
 
+def _parse_quakeml(eventxml):
+    return obspy.read_events(io.BytesIO(eventxml), format="quakeml")
+
+
+def _parse_stationxml(stationxml):
+    return obspy.read_inventory(io.BytesIO(stationxml), format="stationxml")
+
+
 def traverse_dataset(cloudasdfdataset):
-    asdfdict = cloudasdfdataset.read_asdfdict()
-    stations = asdfdict["Waveforms"].keys()
-    for sta in stations:
-        for tag in asdfdict["Waveforms"][sta]:
-            dataset = "/Waveforms/" + sta + "/" + tag
-            if tag == "StationXML":
-                print(cloudasdfdataset.read_stationxml(dataset))
-            else:
-                print(cloudasdfdataset.read_trace(dataset))
+    datasets = [
+        "/Waveforms/%s/%s" % (sta, tag)
+        for sta, tags in cloudasdfdataset.ASDFDict["Waveforms"].items()
+        for tag in tags
+    ]
+
+    # StationXML and waveforms are all fetched with a single parallel read ...
+    readlist = [[_d, 0, 0, -1] for _d in datasets]
+    data = readp_array(cloudasdfdataset._file, readlist)
+
+    # ... and are then decoded in the original traversal order.
+    for dataset in datasets:
+        if dataset.endswith("/StationXML"):
+            stationxml = _string_view(data[dataset])
+            print(cloudasdfdataset._parse_xml(stationxml, _parse_stationxml))
+        else:
+            print(
+                _build_trace(
+                    dataset, data[dataset], **cloudasdfdataset._waveform_info(dataset)
+                )
+            )
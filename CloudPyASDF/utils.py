@@ -6,7 +6,15 @@
 # License
 #    MIT License
 
+import ast
+import collections
+import concurrent.futures
+import functools
 import h5py
+import json
+import threading
+import time
+import zlib
 import xarray
 import numpy as np
 import weakref
@@ -19,16 +27,62 @@ import io
 # from obspy.core.utcdatetime import UTCDateTime
 import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
+
 from .exceptions import WaveformNotInFileError, NoStationXMLForStation, ASDFValueError
 from .inventory_utils import get_coordinates
 
+# Bytes removed by bytes.strip()
+_WHITESPACE = b" \t\n\r\x0b\x0c"
+
+# Magic bytes telling how a dictionary string is compressed. Blosc2 chunks
+# have none, so one is prepended on dump.
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_GZIP_MAGIC = b"\x1f\x8b"
+_BLOSC2_MAGIC = b"BLS2"
+
+# Waveform metadata columns parsed from the trace names.
+_WAVEFORM_COLUMNS = (
+    "network",
+    "station",
+    "position",
+    "channel",
+    "starttime",
+    "endtime",
+    "tag",
+    "npts",
+)
+
 
 def gen_group_dict(group):
     """
-    Recursively traverse a group, generate and return the structure as a dictionary.
+    Traverse a group, generate and return the structure as a dictionary.
+
+    The traversal walks an explicit stack of groups rather than recursing in
+    Python. Members are listed in group.keys() order, which respects
+    track_order, and links are followed like the recursive walk did: hard
+    links to the same object and soft links are each listed under their own
+    name. A link back to a group being traversed is skipped, as it would
+    never end.
+
+    Datasets are described by their length. Waveforms additionally record
+    their dtype and sampling rate, see _dataset_info.
 
     Args:
-        group (h5py._hl.group.Group): hdf5 group to store xarray dataset.
+        group (h5py.Group): hdf5 group to store xarray dataset.
 
     Returns:
         dic (dict): the dictionary tht describe the group's strcuture.
@@ -37,66 +91,161 @@ def gen_group_dict(group):
     # get the group name and avoid full path
     _n = group.name.split("/")[-1]
 
-    if isinstance(group, h5py._hl.dataset.Dataset):
+    if isinstance(group, h5py.Dataset):
         # return dataset name directly
         return {_n: len(group)}
-    else:
-        # recrusively seek into groups
-        dic = {_n: {}}
-        for _obj in list(
-            group.keys()
-        ):  # set will not preserve the order, while list will!
-            dic[_n].update(gen_group_dict(group[_obj]))
-        return dic
+
+    dic = {}
+    # Groups still to be listed, with the dictionary to fill and the ids of
+    # the groups above them.
+    _stack = [(group, dic, (group.id,))]
+    while _stack:
+        _group, _dic, _parents = _stack.pop()
+        for _name, _obj in _group.items():
+            if isinstance(_obj, h5py.Dataset):
+                _dic[_name] = _dataset_info(_obj)
+            elif _obj.id not in _parents:
+                _dic[_name] = {}
+                _stack.append((_obj, _dic[_name], _parents + (_obj.id,)))
+    return {_n: dic}
+
+
+def _dataset_info(dataset):
+    """
+    Helper function describing a dataset in the group dictionary.
+
+    Waveforms are described by their length, dtype and sampling rate so
+    that readers can decode a trace without probing the data. Other
+    datasets are described by their length only.
+
+    Args:
+        dataset (h5py.Dataset): hdf5 dataset
+
+    Returns:
+        info (int or dict):
+    """
+    if "sampling_rate" not in dataset.attrs:
+        return len(dataset)
+    return {
+        "npts": len(dataset),
+        "dtype": dataset.dtype.str,
+        "sampling_rate": float(dataset.attrs["sampling_rate"]),
+    }
+
+
+def _npts(info):
+    """
+    Helper function getting the length from a dataset description.
+    """
+    if isinstance(info, dict):
+        return info["npts"]
+    return info
 
 
-def dump_dict(file, name="ASDFDict", compress=True):
+def dump_dict(file, name="ASDFDict", compress=True, serializer="json", level=None):
     """
     Traverse a group, and store a dictionary in the group that describe
     the group's structure.
 
-    Compression is done by default as when gzip is used (LZW algorithm),
-    the string could be dramatically shortened. This is especially useful
-    for file with small trace/network/station name heterogenity.
+    Compression is done by default as the string could be dramatically
+    shortened. This is especially useful for file with small
+    trace/network/station name heterogenity. By default the dataset is
+    written with HDF5's gzip filter, which compresses chunk by chunk while
+    writing so that no compressed copy of the string is held in memory. The
+    filter is undone by HDF5 (or h5coro) on read, so any reader can open
+    the file. Zstandard, which decompresses several times faster than gzip
+    at a similar ratio, or Blosc2 with its zstd codec can be picked instead,
+    but then the zstandard or blosc2 package is required wherever the file
+    is read.
+
+    The dictionary is serialized as JSON by default. msgpack gives a smaller
+    binary payload that is faster to parse, but requires the msgpack package
+    wherever the file is read.
 
     Args:
-        from_group (h5py._hl.group.Group): from which group the dict is dumped
-        to_group (h5py._hl.group.Group): to where the dict is stored
+        file (str or h5py.File): file from which the dict is dumped
         name (str): dataset name taht store the dictionary
-        compress (bool): decide whether to compress string
+        compress (bool or str): decide whether to compress string, could
+            also be "hdf5" (HDF5 gzip filter, same as True), "gzip", "zstd"
+            or "blosc2" to pick the codec
+        serializer (str): "json" or "msgpack"
+        level (int): compression level, defaults to 3 for zstd and blosc2
+            and 1 for gzip and hdf5
 
     Examples:
-        >>> CloudPyASDF.utils.dump_dict(ds['/'], ds['/AuxiliaryData'], "ASDFDict")
+        >>> CloudPyASDF.utils.dump_dict("asdf.h5", "ASDFDict", compress="zstd")
     """
-    import gzip
+    if serializer not in ("json", "msgpack"):
+        raise ASDFValueError("Unknown serializer '%s'." % serializer)
+    if serializer == "msgpack" and msgpack is None:
+        raise ASDFValueError("msgpack is required for the msgpack serializer.")
+
+    if compress is True:
+        compress = "hdf5"
+    if compress and compress not in ("zstd", "gzip", "blosc2", "hdf5"):
+        raise ASDFValueError("Unknown compression '%s'." % compress)
+    if compress == "zstd" and zstandard is None:
+        raise ASDFValueError("zstandard is required for zstd compression.")
+    if compress == "blosc2" and blosc2 is None:
+        raise ASDFValueError("blosc2 is required for blosc2 compression.")
+
+    # Arguments are checked before the file is touched, so that a bad call
+    # never leaves it without a dictionary.
+    opened = not isinstance(file, h5py.File)
+    group = h5py.File(file, "a") if opened else file
+    try:
+        _dump_dict(group, name, compress, serializer, level)
+    finally:
+        if opened:
+            group.close()
 
-    # Check argument type...
-    if isinstance(file, h5py._hl.files.File):
-        group = file
-    else:
-        group = h5py.File(file, "a")
 
+def _dump_dict(group, name, compress, serializer, level):
+    """
+    Helper function serializing, compressing and writing the dictionary
+    once dump_dict has checked its arguments.
+    """
     try:
         del group["/AuxiliaryData/ASDFDict"]
     except:
         pass
 
-    s = str(gen_group_dict(group["/"])).encode()
-
-    if compress:
-        comp_s = gzip.compress(s)
-        group["/AuxiliaryData"].create_dataset(
-            name, data=np.frombuffer(comp_s, dtype="uint8"), maxshape=(None,)
-        )
+    dic = gen_group_dict(group["/"])
+    if serializer == "json":
+        # Compact separators drop the padding spaces json adds by default.
+        s = json.dumps(dic, separators=(",", ":")).encode()
     else:
-        group["/AuxiliaryData"].create_dataset(
-            name, data=np.frombuffer(s, dtype="uint8"), maxshape=(None,)
+        s = msgpack.packb(dic)
+
+    kwargs = {}
+
+    if compress == "zstd":
+        s = zstandard.ZstdCompressor(
+            level=3 if level is None else level, threads=-1
+        ).compress(s)
+    elif compress == "gzip":
+        # zlib with wbits=31 writes the gzip format without the overhead of
+        # gzip.compress, which also defaults to the slowest level. Level 1
+        # keeps most of the ratio on the repetitive dict at a fraction of
+        # the time.
+        _z = zlib.compressobj(1 if level is None else level, zlib.DEFLATED, 31)
+        s = _z.compress(s) + _z.flush()
+    elif compress == "blosc2":
+        s = _BLOSC2_MAGIC + blosc2.compress2(
+            s, codec=blosc2.Codec.ZSTD, clevel=3 if level is None else level
         )
+    elif compress == "hdf5":
+        kwargs = {
+            "compression": "gzip",
+            "compression_opts": 1 if level is None else level,
+            "chunks": (min(len(s), 1 << 20),),
+        }
 
-    if isinstance(file, h5py._hl.files.File):
-        pass
-    else:
-        group.close()
+    # The dictionary is written once and read whole, so it is stored
+    # contiguously unless the HDF5 filter needs chunks.
+    group["/AuxiliaryData"].create_dataset(
+        name, data=np.frombuffer(s, dtype="uint8"), **kwargs
+    )
 
 
 def read_dict(h5file, path):
@@ -110,61 +259,76 @@ def read_dict(h5file, path):
     Return:
         dic (dict): the dictionary tht describe the group's strcuture.
     """
-    import gzip
-    from numpy import array as array
-    from numpy import float32 as float32
+    return _decode_dict(h5file.read(path))
 
-    _str = h5file.read(path)
-    _str = np.array(_str, dtype="uint8")
-    _str_byte = _read_string_array(_str)
 
-    try:
-        # Decompress string
-        _str_byte = gzip.decompress(_str_byte)
-    except:
-        # Perhaps compression is surpressed?
-        pass
-
-    dic = eval(_str_byte)
-
-    return dic
-
-
-def readp_dict(h5file, readp_list, prefix="", suffix=""):
+def readp_dict(h5file, readp_list, prefix="", suffix="", max_workers=8):
     """
     Read and decode into dictionary from HDF5 file with h5coro in multi-thread.
 
+    The dictionaries are decoded in a thread pool as well. Decompression
+    releases the GIL, so the decoding of separate datasets overlaps.
+
     Args:
         h5file (sliderule.h5coro): h5coro file object
         readp_list (list): see h5coro.readp()
         prefix (str): global prefix for readp_list's path
         suffix (str): global suffix for readp_list's path
+        max_workers (int): maximum number of concurrent readp calls and of
+            decoding threads
 
     """
-    # For some modules like xarray, it just don't show full name of arrays and data type.
-    # This is required to avoid eval error.
-    import gzip
-    from numpy import array as array
-    from numpy import float32 as float32
+    _readp_list = [[prefix + i[0] + suffix, i[1], i[2], i[3]] for i in readp_list]
+    _dict = _readp_batched(h5file, _readp_list, max_workers=max_workers)
 
-    _readp_list = [[prefix + i[0], i[1], i[2], i[3]] for i in readp_list]
-    _readp_list = [[i[0] + suffix, i[1], i[2], i[3]] for i in _readp_list]
-    _dict = h5file.readp(_readp_list)
+    # Full paths are looked up as already built for the request.
+    _strs = [_dict[_r[0]] for _r in _readp_list]
+    if len(_strs) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _dicts = list(executor.map(_decode_dict, _strs))
+    else:
+        _dicts = [_decode_dict(_s) for _s in _strs]
 
-    new_dict = {}
-    for item in readp_list:
-        _str = np.array(_dict[prefix + item[0] + suffix], dtype="uint8")
-        _str_byte = _read_string_array(_str)
+    return {item[0]: _d for item, _d in zip(readp_list, _dicts)}
 
-        try:
-            # Decompress string
-            _str_byte = gzip.decompress(_str_byte)
-        except:
-            # Perhaps compression is surpressed?
-            pass
 
-        new_dict[item[0]] = eval(_str_byte)
-    return new_dict
+def _decode_dict(array):
+    """
+    Helper function decoding a dictionary dataset as read by h5coro.
+
+    Args:
+        array (numpy.array or bytes-like): dictionary dataset
+
+    Returns:
+        dic (dict): the parsed dictionary
+    """
+    return _loads_dict(_decompress(_read_string_array(array, strip=False)))
+
+
+def _readp_batched(h5file, readp_list, max_workers=8):
+    """
+    Helper function issuing a readp in batches from a thread pool.
+
+    The batch size is picked so that about max_workers batches are in
+    flight, bounded to 64-512 requests. Short lists still go out in a single
+    call, while long ones overlap their latency rather than stalling one
+    monolithic readp on its slowest read.
+
+    Args:
+        h5file (sliderule.h5coro): h5coro file object
+        readp_list (list): see h5coro.readp()
+        max_workers (int): maximum number of concurrent readp calls
+    """
+    batch = min(max(-(-len(readp_list) // max_workers), 64), 512)
+    if len(readp_list) <= batch:
+        return h5file.readp(readp_list)
+
+    _batches = [readp_list[_i : _i + batch] for _i in range(0, len(readp_list), batch)]
+    _dict = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _d in executor.map(h5file.readp, _batches):
+            _dict.update(_d)
+    return _dict
 
 
 def readp_array(h5file, readp_list, prefix="", suffix=""):
@@ -179,60 +343,442 @@ def readp_array(h5file, readp_list, prefix="", suffix=""):
         suffix (str): global suffix for readp_list's path
     """
     _readp_list = [[prefix + i[0] + suffix, i[1], i[2], i[3]] for i in readp_list]
+    # A single dataset is read directly, skipping readp's dispatch.
+    if len(_readp_list) == 1:
+        return {readp_list[0][0]: h5file.read(*_readp_list[0])}
     _dict = h5file.readp(_readp_list)
 
     _new_dict = {}
-    for item in readp_list:
-        _new_dict[item[0]] = _dict[prefix + item[0] + suffix]
+    for item, _r in zip(readp_list, _readp_list):
+        _new_dict[item[0]] = _dict[_r[0]]
 
     return _new_dict
 
 
-def _read_string_array(array):
+def _decompress(string):
+    """
+    Helper function decompressing a dictionary string.
+
+    The codec is told from the magic bytes at the start of the string:
+    Zstandard frames start with 28 b5 2f fd, gzip members with 1f 8b and
+    Blosc2 chunks with the "BLS2" header written by dump_dict.
+    Anything else is returned unchanged, as the dictionary was dumped
+    without compression or with the HDF5 filter.
+
+    Args:
+        string (bytes): dictionary string as stored in the file
+
+    Returns:
+        bytes (bytes):
+    """
+    if string[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise ASDFValueError("zstandard is required to read this dictionary.")
+        return zstandard.ZstdDecompressor().decompress(string)
+    if string[:2] == _GZIP_MAGIC:
+        # wbits=31 reads the gzip format, skipping gzip's header parsing in
+        # Python.
+        return zlib.decompress(string, 31)
+    if string[:4] == _BLOSC2_MAGIC:
+        if blosc2 is None:
+            raise ASDFValueError("blosc2 is required to read this dictionary.")
+        return blosc2.decompress2(memoryview(string)[4:])
+    return string
+
+
+def _loads_dict(string):
+    """
+    Helper function parsing a decoded dictionary string.
+
+    Dictionaries are dumped as JSON or msgpack. A msgpack map always starts
+    with a byte >= 0x80 while JSON and Python literals start with "{", so
+    the first byte tells the two apart. Files written before the switch to
+    JSON were dumped as Python literals, so those are still parsed with
+    ast.literal_eval as a fallback. Unlike eval, it neither compiles nor
+    runs code, which also means that repr'd numpy arrays are not accepted:
+    arrays must be stored as JSON going forward.
+
+    Args:
+        string (bytes): decompressed dictionary string
+
+    Returns:
+        dic (dict): the parsed dictionary
+    """
+    if string[:1] >= b"\x80":
+        if msgpack is None:
+            raise ASDFValueError("msgpack is required to read this dictionary.")
+        return msgpack.unpackb(string, raw=False, strict_map_key=False)
+
+    try:
+        return json.loads(string)
+    except ValueError:
+        return ast.literal_eval(string.decode())
+
+
+def _read_string_array(array, strip=True):
     """
     Helper function taking a string data and preparing it so it can be
     read to other object.
 
     As string array are stored as ASCII-int in HDF5, decode is required.
 
-    data (numpy.array): data array that encodes a string
+    h5coro may hand back a numpy array or a plain bytes-like buffer.
+    Single-byte arrays and buffers are viewed as raw bytes directly, so no
+    intermediate int8 array is allocated. Wider integer arrays are
+    narrowed once.
 
     Args:
-        array (numpy.array):
+        array (numpy.array or bytes-like): data that encodes a string
+        strip (bool): strip surrounding whitespace, which must not be done
+            for compressed payloads
 
     Returns:
         bytes (bytes):
     """
-    return array[()].tobytes().strip()
+    if isinstance(array, np.ndarray):
+        if array.itemsize != 1:
+            array = array.astype("u1")
+        # Strided arrays are made contiguous first so that tobytes is a
+        # single memcpy. This is a no-op for contiguous arrays.
+        _bytes = np.ascontiguousarray(array).tobytes()
+    else:
+        try:
+            _bytes = bytes(memoryview(array).cast("B"))
+        except TypeError:
+            # Lists of ints are converted by numpy in a single C loop. int16
+            # holds both int8 and uint8 values, which the cast then wraps.
+            _bytes = np.array(array, dtype="int16").astype("u1").tobytes()
+    if strip:
+        return _bytes.strip()
+    return _bytes
 
 
-def parse_trace(dname, data):
-    _code, _starttime, _endtime, tag = dname.split("__")
-    net, sta, loc, cha = _code.split(".")
-    t = obspy.Trace()
-    t.data = np.array(data)
+def _string_view(array):
+    """
+    Helper function returning a string array as a stripped memoryview.
 
-    try:
-        starttime = datetime.datetime.strptime(_starttime[:26], "%Y-%m-%dT%H:%M:%S.%f")
-        endtime = datetime.datetime.strptime(_endtime[:26], "%Y-%m-%dT%H:%M:%S.%f")
-    except:
-        starttime = datetime.datetime.strptime(_starttime, "%Y-%m-%dT%H:%M:%S")
-        endtime = datetime.datetime.strptime(_endtime, "%Y-%m-%dT%H:%M:%S")
-    delta = (endtime - starttime).total_seconds()
-    sampling_rate = (len(data) - 1) / delta
-
-    setattr(t.stats, "tag", tag)
-    # setattr(t.stats, "delta", delta.total_seconds())
-    setattr(t.stats, "starttime", starttime)
-    setattr(t.stats, "sampling_rate", sampling_rate)
-    setattr(t.stats, "network", net)
-    setattr(t.stats, "station", sta)
-    setattr(t.stats, "location", loc)
-    setattr(t.stats, "channel", cha)
+    Unlike _read_string_array, no bytes object is created. The view is taken
+    over the buffer h5coro returned, and surrounding whitespace is trimmed by
+    moving the bounds of the view. It can be handed to io.BytesIO directly,
+    which then holds the only copy of the string.
+
+    Args:
+        array (numpy.array or bytes-like): data that encodes a string
+
+    Returns:
+        view (memoryview):
+    """
+    if isinstance(array, np.ndarray):
+        if array.itemsize != 1:
+            array = array.astype("u1")
+        _view = memoryview(np.ascontiguousarray(array)).cast("B")
+    else:
+        try:
+            _view = memoryview(array).cast("B")
+        except TypeError:
+            _view = memoryview(np.array(array, dtype="int16").astype("u1"))
+
+    start, end = 0, len(_view)
+    while start < end and _view[start] in _WHITESPACE:
+        start += 1
+    while end > start and _view[end - 1] in _WHITESPACE:
+        end -= 1
+    return _view[start:end]
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(string):
+    """
+    Helper function parsing a timestamp from a waveform name.
+
+    Timestamps look like "2021-01-01T00:00:00" or "2021-01-01T00:00:00.000000".
+    These are handed to datetime.fromisoformat, which parses them in C.
+    Other fraction widths, which fromisoformat rejects before Python 3.11,
+    are sliced at fixed positions rather than going through
+    datetime.strptime, which re-parses its format string on every call.
+    Traces of a station tend to share their start and end times, so parsed
+    timestamps are cached.
+
+    Args:
+        string (str): timestamp field of a waveform name
+
+    Returns:
+        datetime (datetime.datetime):
+    """
+    # Lengths without a fraction or with 3 or 6 digits, never a UTC offset.
+    if len(string) in (19, 23, 26):
+        try:
+            return datetime.datetime.fromisoformat(string)
+        except ValueError:
+            pass
+
+    microsecond = 0
+    if len(string) > 20 and string[19] == ".":
+        microsecond = int(string[20:26].ljust(6, "0"))
+    return datetime.datetime(
+        int(string[0:4]),
+        int(string[5:7]),
+        int(string[8:10]),
+        int(string[11:13]),
+        int(string[14:16]),
+        int(string[17:19]),
+        microsecond,
+    )
 
+
+def parse_trace(dname, data):
+    """
+    Build an ObsPy Trace, with its tag, from waveform data that has already
+    been read.
+
+    Args:
+        dname (str): waveform name or path, looks like
+            "UW.OSD..EHZ__2021-01-01T00:00:00__2021-01-01T00:10:00__raw_recording"
+        data (numpy.array or list): waveform samples
+    """
+    t = _build_trace(dname, data)
+    t.stats.tag = dname.rsplit("__", 1)[-1]
     return t
 
 
+def _build_trace(dataset, data, dtype=None, sampling_rate=None):
+    """
+    Build an ObsPy Trace from waveform data that has already been read.
+
+    Args:
+        dataset (str): path to waveform data
+        data (numpy.array, bytes-like or list): waveform samples read from
+            dataset
+        dtype (str): sample dtype, used to view a raw buffer without copy
+        sampling_rate (float): sampling rate, derived from the trace name
+            and length if not given
+    """
+    # The name is split only once into its code and time fields.
+    _code, _starttime, _endtime = dataset.rsplit("/", 1)[-1].split("__", 3)[:3]
+    _i = _code.split(".", 3)
+    if isinstance(data, np.ndarray) or dtype is None:
+        data = np.asarray(data)
+    else:
+        try:
+            # Buffers are viewed without a copy ...
+            data = np.frombuffer(data, dtype=dtype)
+        except TypeError:
+            # ... while lists of samples are converted once.
+            data = np.asarray(data, dtype=dtype)
+        else:
+            # Immutable buffers such as bytes give read-only arrays, which
+            # would break in-place ObsPy operations.
+            if not data.flags.writeable:
+                data = data.copy()
+
+    starttime = _parse_datetime(_starttime)
+    if sampling_rate is None:
+        endtime = _parse_datetime(_endtime)
+        sampling_rate = (len(data) - 1) / (endtime - starttime).total_seconds()
+
+    # Stats are initialized from a single header rather than per-attribute
+    # setattr calls.
+    header = {
+        "starttime": obspy.UTCDateTime(starttime),
+        "sampling_rate": sampling_rate,
+        "network": _i[0],
+        "station": _i[1],
+        "location": _i[2],
+        "channel": _i[3],
+    }
+    return obspy.Trace(data=data, header=header)
+
+
+class H5pyFile(object):
+    """
+    Reader for local HDF5 files with the same read/readp interface as
+    sliderule.h5coro.
+
+    Local files are opened with h5py so that the raw data chunk cache can be
+    tuned. The cache set on the file applies to every dataset opened from it
+    (the per-dataset equivalent of H5Pset_chunk_cache). With a cache large
+    enough to hold the chunks of a station, chunks shared by several traces
+    stay resident instead of being decompressed again on every read.
+    """
+
+    def __init__(
+        self, filename, rdcc_nbytes=64 * 1024**2, rdcc_nslots=10007, rdcc_w0=0.75
+    ):
+        """
+        Args:
+            filename (str): path to the local HDF5 file
+            rdcc_nbytes (int): raw data chunk cache size in bytes
+            rdcc_nslots (int): number of chunk slots in the cache hash table,
+                preferably a prime about 100 times the number of hot chunks
+            rdcc_w0 (float): chunk preemption policy, see h5py.File
+        """
+        self._file = h5py.File(
+            filename,
+            "r",
+            rdcc_nbytes=rdcc_nbytes,
+            rdcc_nslots=rdcc_nslots,
+            rdcc_w0=rdcc_w0,
+        )
+
+    def close(self):
+        """
+        Close the h5py file handle, so that the file can be opened for
+        writing again, e.g. by dump_dict.
+        """
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, dataset, col=0, startrow=0, numrows=-1):
+        _ds = self._file[dataset]
+        if numrows < 0:
+            return _ds[startrow:]
+        return _ds[startrow : startrow + numrows]
+
+    def readp(self, readp_list):
+        """
+        Read several datasets. When they are all one-dimensional and share a
+        numeric dtype, such as the traces of a station, they are read with
+        read_direct into slices of a single preallocated buffer instead of
+        allocating one array each.
+        """
+        _datasets = [self._file[_r[0]] for _r in readp_list]
+        _dtypes = {_ds.dtype for _ds in _datasets}
+        if (
+            len(_dtypes) != 1
+            or not np.issubdtype(next(iter(_dtypes)), np.number)
+            or any(_ds.ndim != 1 for _ds in _datasets)
+        ):
+            return {_r[0]: self.read(*_r) for _r in readp_list}
+
+        _sels = []
+        for _ds, _r in zip(_datasets, readp_list):
+            _start = min(_r[2], len(_ds))
+            _stop = len(_ds) if _r[3] < 0 else min(_r[2] + _r[3], len(_ds))
+            _sels.append(slice(_start, max(_start, _stop)))
+
+        _out = np.empty(sum(_s.stop - _s.start for _s in _sels), dtype=_dtypes.pop())
+        _dict = {}
+        _off = 0
+        for _ds, _r, _s in zip(_datasets, readp_list, _sels):
+            _view = _out[_off : _off + _s.stop - _s.start]
+            if len(_view):
+                _ds.read_direct(_view, source_sel=_s)
+            _dict[_r[0]] = _view
+            _off += len(_view)
+        return _dict
+
+
+class CachedH5Coro(object):
+    """
+    Wrapper around a h5coro file object that caches reads.
+
+    It is meant for small metadata such as StationXML, QuakeML and the ASDF
+    dictionary, not for waveforms. Reads are keyed on (dataset, col,
+    startrow, numrows). Concurrent callers asking for the same key wait for
+    the first fetch instead of issuing their own request, and results are
+    kept in a small LRU cache whose entries expire after the S3 presigned
+    URL lifetime. Every caller gets the same object back, so reads are
+    cached as read-only arrays or bytes.
+    """
+
+    def __init__(self, h5file, maxsize=128, maxbytes=64 * 1024**2, ttl=55 * 60):
+        """
+        Args:
+            h5file (sliderule.h5coro or H5pyFile): file object to wrap
+            maxsize (int): maximum number of cached reads
+            maxbytes (int): maximum total size of cached reads in bytes.
+                Larger reads are returned without being cached.
+            ttl (float): seconds after which a cached read expires
+        """
+        self._h5file = h5file
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self._cache = collections.OrderedDict()
+        self._nbytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        """
+        Drop the cached reads. The wrapped file object is left open.
+        """
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def _get(self, key):
+        # Must be called with the lock held.
+        _hit = self._cache.get(key)
+        if _hit is None:
+            return None
+        if time.monotonic() - _hit[0] > self.ttl:
+            self._pop(key)
+            return None
+        self._cache.move_to_end(key)
+        return _hit
+
+    def _pop(self, key=None):
+        # Must be called with the lock held. Without a key, the least
+        # recently used entry is dropped.
+        if key is None:
+            _hit = self._cache.popitem(last=False)[1]
+        else:
+            _hit = self._cache.pop(key)
+        self._nbytes -= _hit[2]
+
+    def _put(self, key, data):
+        # Must be called with the lock held. Returns the data as cached.
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        elif isinstance(data, list):
+            # h5coro returns strings as lists of int8 or uint8 values, see
+            # _read_string_array.
+            data = np.array(data, dtype="int16").astype("u1")
+            data.flags.writeable = False
+        elif not isinstance(data, bytes):
+            data = bytes(memoryview(data).cast("B"))
+        nbytes = data.nbytes if isinstance(data, np.ndarray) else len(data)
+        if nbytes > self.maxbytes:
+            return data
+        if key in self._cache:
+            self._pop(key)
+        self._cache[key] = (time.monotonic(), data, nbytes)
+        self._nbytes += nbytes
+        while len(self._cache) > self.maxsize or self._nbytes > self.maxbytes:
+            self._pop()
+        return data
+
+    def read(self, dataset, col=0, startrow=0, numrows=-1):
+        key = (dataset, col, startrow, numrows)
+        while True:
+            with self._lock:
+                _hit = self._get(key)
+                if _hit is not None:
+                    return _hit[1]
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+            # Someone else is fetching the same range, wait and look again.
+            event.wait()
+
+        try:
+            data = self._h5file.read(dataset, col, startrow, numrows)
+            with self._lock:
+                data = self._put(key, data)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+        return data
+
+
 class StationAccessor(object):
     """
     Helper class to facilitate access to the waveforms and stations.
@@ -241,16 +787,24 @@ class StationAccessor(object):
     def __init__(self, cloudasdfdataset):
         self.data_set = weakref.ref(cloudasdfdataset)
         self.station_dict = self.data_set().ASDFDict["Waveforms"]
+        # Station names are sorted once, see WaveformAccessor.__init__.
+        self._sorted = tuple(sorted(self.station_dict.keys()))
+        self._key_set = frozenset(self._sorted)
+        # Accessors are kept so that their caches live across accesses.
+        self._accessors = {}
+        self._dir = None
 
     def list(self):
-        return sorted([_i for _i in self.station_dict.keys()])
+        return self._sorted
 
     def __dir__(self):
         """
         Examples:
             >>> dir(ds.waveforms)
         """
-        return [_i.replace(".", "_") for _i in self.list()]
+        if self._dir is None:
+            self._dir = tuple(_i.replace(".", "_") for _i in self.list())
+        return self._dir
 
     def __len__(self):
         """
@@ -274,20 +828,25 @@ class StationAccessor(object):
         """
         if replace:
             item = str(item).replace("_", ".")
-        if item not in self.list():
+        if item not in self._key_set:
             raise AttributeError("Attribute '%s' not found." % item)
-        return WaveformAccessor(item, self.data_set())
+        return self._get_accessor(item)
 
     def __getitem__(self, item):
         # Item access with replaced underscore and without. This is not
         # strictly valid ASDF but it helps to be flexible.
-        try:
-            return self.__getattr__(item, replace=False)
-        except AttributeError:
-            try:
-                return self.__getattr__(item, replace=True)
-            except AttributeError as e:
-                raise KeyError(str(e))
+        if item not in self._key_set:
+            item = str(item).replace("_", ".")
+            if item not in self._key_set:
+                raise KeyError("Attribute '%s' not found." % item)
+        return self._get_accessor(item)
+
+    def _get_accessor(self, station_name):
+        if station_name not in self._accessors:
+            self._accessors[station_name] = WaveformAccessor(
+                station_name, self.data_set()
+            )
+        return self._accessors[station_name]
 
 
 class WaveformAccessor(object):
@@ -301,14 +860,33 @@ class WaveformAccessor(object):
         self.station_name = station_name
         self.data_set = weakref.ref(data_set)
         self.waveform_dict = self.data_set().ASDFDict["Waveforms"][station_name]
+        # The ASDF dictionary does not change while the file is open, so the
+        # listing, tag index, dir() output and parsed names derived from it
+        # are built once. They are kept as tuples so that callers cannot
+        # modify the shared copies.
+        self._list = (
+            tuple(self.waveform_dict.keys()),
+            tuple(_npts(_v) for _v in self.waveform_dict.values()),
+        )
+        self._key_set = frozenset(self._list[0])
+        # Trace names by tag, so that tag access is a single lookup.
+        self._tag_index = {}
+        for _k in self.waveform_dict:
+            if _k != "StationXML":
+                self._tag_index.setdefault(_k.rsplit("__", 1)[-1], []).append(_k)
+        self._tag_index = {_t: tuple(_k) for _t, _k in self._tag_index.items()}
+        self._waveform_tags = tuple(sorted(self._tag_index))
+        # Parsed trace names, see _waveform_content.
+        self._content = None
+        self._dir = None
+        # Parsed StationXML coordinates by level.
+        self._coord_cache = {}
 
     def get_waveform_tags(self):
         """
         Get all available waveform tags for this station.
         """
-        return sorted(
-            set(_i.split("__")[-1] for _i in self.list()[0] if _i != "StationXML")
-        )
+        return self._waveform_tags
 
     @property
     def coordinates(self):
@@ -346,8 +924,12 @@ class WaveformAccessor(object):
 
     def __get_coordinates(self, level):
         """
-        Helper function.
+        Helper function. Coordinates are cached per level as the StationXML
+        does not change while the file is open.
         """
+        if level in self._coord_cache:
+            return self._coord_cache[level]
+
         if "StationXML" not in self.waveform_dict:
             raise NoStationXMLForStation(
                 "Station '%s' has no StationXML " "file." % self.station_name
@@ -362,6 +944,7 @@ class WaveformAccessor(object):
         finally:
             pass
 
+        self._coord_cache[level] = coordinates
         return coordinates
 
     def __getattr__(self, item):
@@ -369,19 +952,11 @@ class WaveformAccessor(object):
 
     def __iter__(self):
         content = self._waveform_content()
-        for c in content:
-            t = self.data_set().read_trace(
-                "/".join(["/Waveforms", self.station_name, c[8]])
-            )
-            # t.stats.network = c[0]
-            # t.stats.station = c[1]
-            # t.stats.location = c[2]
-            # t.stats.channel = c[3]
-            # t.stats.starttime = UTCDateTime(c[4])
-            # t.stats.endtime = UTCDateTime(c[5])
-            # t.stats.delta = (UTCDateTime(c[5]) - UTCDateTime(c[4]))/c[7]
-            setattr(t.stats, "tag", c[6])
-            # t.stats.npts = c[7]
+        # All traces are fetched with a single readp rather than one read
+        # per trace. readp_trace keeps the order and sets the tags.
+        for t in self.data_set().readp_trace(
+            ["/".join(["/Waveforms", self.station_name, _i]) for _i in content["name"]]
+        ):
             yield t
 
     def dataless(self):
@@ -395,17 +970,15 @@ class WaveformAccessor(object):
         if item == "StationXML":
             return [item]
 
-        _l = self.list()[0]
-
         # Single trace access
         # items would be something looks like
         # 'UW.OSD..EHZ__2021-01-01T00:00:00__2021-01-01T01:00:00__raw_recording'
-        if item in _l:
+        if item in self._key_set:
             return [item]
 
         # Tag access. '__' is always contained in a trace's name.
         elif "__" not in item:
-            keys = [_i for _i in self.list()[0] if _i.endswith("__" + item)]
+            keys = self._tag_index.get(item)
 
             if not keys:
                 raise WaveformNotInFileError(
@@ -418,33 +991,12 @@ class WaveformAccessor(object):
 
     @property
     def dataframe(self):
-        lst, npts = self.list()
-        spt = [
-            it.split("__")[0].split(".") + it.split("__")[1:] + [npt]
-            for it, npt in zip(lst, npts)
-        ]
-        # starttime = [it.split('__')[1] for it in lst]
-        # endtime = [it.split('__')[2] for it in lst]
-        # tag = [it.split('__')[3] for it in lst]
-
-        df = pandas.DataFrame(
-            spt,
-            columns=[
-                "network",
-                "station",
-                "position",
-                "channel",
-                "starttime",
-                "endtime",
-                "tag",
-                "npts",
-            ],
-        )
-
-        return df
+        content = self._waveform_content()
+        return pandas.DataFrame({_k: content[_k] for _k in _WAVEFORM_COLUMNS})
 
     def get_item(self, item, starttime=None, endtime=None, parse=False):
         items = self.filter_data(item)
+        ds = self.data_set()
         # StationXML access.
         if items == ["StationXML"]:
             if "StationXML" not in self.waveform_dict:
@@ -452,7 +1004,7 @@ class WaveformAccessor(object):
                     " %s contians no StationXML" % self.station_name
                 )
             else:
-                station = self.data_set().read_stationxml(
+                station = ds.read_stationxml(
                     "/Waveforms/%s/StationXML" % self.station_name
                 )
                 if station is None:
@@ -495,7 +1047,6 @@ class WaveformAccessor(object):
         #         raise ASDFValueError(msg)
 
         ret_str = "{ntrace} Trace(s) in Stream:\n" "{trace}"
-        waveform_content = self._waveform_content()
         # print(ret_str.format(
         #     ntrace = self.count_tag(item),
         #     trace =
@@ -504,7 +1055,7 @@ class WaveformAccessor(object):
         #         )
         # ))
         if parse:
-            return self.data_set().readp_trace(
+            return ds.readp_trace(
                 ["/".join(["/Waveforms", self.station_name, _i]) for _i in items]
             )
         else:
@@ -512,48 +1063,68 @@ class WaveformAccessor(object):
             readlist = []
             for _d in datasets:
                 readlist.append([_d, 0, 0, -1])
-            return readp_array(self.data_set()._file, readlist)
+            return readp_array(ds._file, readlist)
 
     def _waveform_content(self):
-        content = []
-        for i, npt in zip(self.list()[0], self.list()[1]):
-            if i != "StationXML":
-                code, starttime, endtime, tag = i.split("__")
-                net, sta, loc, cha = code.split(".")
-                content.append([net, sta, loc, cha, starttime, endtime, tag, npt, i])
-        return content
+        """
+        Get the metadata parsed from the trace names of this station, except
+        the StationXML, as a dict of columns (see _WAVEFORM_COLUMNS) plus the
+        trace names under "name".
+        """
+        if self._content is None:
+            names, npts = self.list()
+            names = pandas.Series(names, dtype=object)
+            keep = (names != "StationXML").to_numpy()
+            names = names[keep]
+
+            # Names are split column-wise by pandas rather than row by row.
+            content = {}
+            if len(names):
+                fields = names.str.split("__", n=3, expand=True)
+                codes = fields[0].str.split(".", n=3, expand=True)
+                _columns = [codes[_i] for _i in range(4)]
+                _columns += [fields[_i] for _i in range(1, 4)]
+                for _k, _c in zip(_WAVEFORM_COLUMNS, _columns):
+                    content[_k] = _c.to_numpy()
+            else:
+                for _k in _WAVEFORM_COLUMNS[:-1]:
+                    content[_k] = np.array([], dtype=object)
+            content["npts"] = np.asarray(npts, dtype=np.int64)[keep]
+            content["name"] = names.to_numpy()
+            self._content = content
+        return self._content
 
     def count_tag(self, tag):
-        n = 0
-        for it in self.list()[0]:
-            if it.split("__")[-1] == tag:
-                n += 1
-        return n
+        return len(self._tag_index.get(tag, ()))
 
     def list(self):
         """
         Get a list of all data sets for this station.
         """
-        return [list(self.waveform_dict.keys()), list(self.waveform_dict.values())]
+        return self._list
 
     def __dir__(self):
         """
         The dir method will list all this object's methods, the StationXML
         if it has one, and all tags.
         """
+        if self._dir is not None:
+            return self._dir
+
         # Python 3.
         if hasattr(object, "__dir__"):  # pragma: no cover
             directory = object.__dir__(self)
 
         directory.extend(self.get_waveform_tags())
-        if "StationXML" in self.list():
+        if "StationXML" in self.waveform_dict:
             directory.append("StationXML")
         directory.extend(["station_name", "coordinates", "channel_coordinates"])
-        return sorted(set(directory))
+        self._dir = tuple(sorted(set(directory)))
+        return self._dir
 
     def __str__(self):
         contents = self.__dir__()
-        waveform_contents = sorted(self.get_waveform_tags())
+        waveform_contents = self.get_waveform_tags()
 
         ret_str = (
             "Contents of the data set for station {station}:\n"
@@ -586,45 +1157,40 @@ class WaveformAccessor(object):
 
 class DatalessWaveformAccessor(WaveformAccessor):
     def __init__(self, station_name, data_set):
-        self.station_name = station_name
-        self.data_set = data_set
-        self.waveform_dict = self.data_set().ASDFDict["Waveforms"][station_name]
+        # data_set is already a weak reference.
+        super().__init__(station_name, data_set())
 
     def __iter__(self):
         content = super()._waveform_content()
-        for c in content:
-            t = obspy.Trace()
-            # t.stats.network = c[0]
-            # t.stats.station = c[1]
-            # t.stats.location = c[2]
-            # t.stats.channel = c[3]
-            # t.stats.starttime = UTCDateTime(c[4])
-            # t.stats.endtime = UTCDateTime(c[5])
-            # t.stats.delta = (UTCDateTime(c[5]) - UTCDateTime(c[4]))/c[7]
-
-            t.stats.npts = c[7]
-
-            try:
-                starttime = datetime.datetime.strptime(
-                    c[4][:26], "%Y-%m-%dT%H:%M:%S.%f"
-                )
-                endtime = datetime.datetime.strptime(c[5][:26], "%Y-%m-%dT%H:%M:%S.%f")
-            except:
-                starttime = datetime.datetime.strptime(c[4], "%Y-%m-%dT%H:%M:%S")
-                endtime = datetime.datetime.strptime(c[5], "%Y-%m-%dT%H:%M:%S")
-            delta = (endtime - starttime).total_seconds()
-            sampling_rate = (c[7] - 1) / delta
-
-            setattr(t.stats, "tag", c[6])
-            # setattr(t.stats, "delta", delta.total_seconds())
-            setattr(t.stats, "starttime", starttime)
-            setattr(t.stats, "sampling_rate", sampling_rate)
-            setattr(t.stats, "network", c[0])
-            setattr(t.stats, "station", c[1])
-            setattr(t.stats, "location", c[2])
-            setattr(t.stats, "channel", c[3])
-
-            yield t
+        # Times and sampling rates of all traces are parsed and computed by
+        # numpy at once rather than per trace.
+        starttimes = content["starttime"].astype("datetime64[us]")
+        endtimes = content["endtime"].astype("datetime64[us]")
+        deltas = (endtimes - starttimes) / np.timedelta64(1, "s")
+        sampling_rates = (content["npts"] - 1) / deltas
+
+        for net, sta, loc, cha, tag, npts, starttime, sampling_rate in zip(
+            content["network"],
+            content["station"],
+            content["position"],
+            content["channel"],
+            content["tag"],
+            content["npts"],
+            starttimes.astype(object),
+            sampling_rates,
+        ):
+            # The header's npts is kept as the trace has no data.
+            header = {
+                "npts": int(npts),
+                "tag": tag,
+                "starttime": obspy.UTCDateTime(starttime),
+                "sampling_rate": sampling_rate,
+                "network": net,
+                "station": sta,
+                "location": loc,
+                "channel": cha,
+            }
+            yield obspy.Trace(header=header)
 
 
 class AuxiliaryDataGroupAccessor(object):
@@ -6,21 +6,31 @@
 # License
 #    MIT License
 
+import json
 import xarray
 import h5py
 import numpy as np
-from .utils import dump_dict
+from .utils import gen_group_dict
 
 
-def embed_xarray(ds, group, name="XR"):
+def embed_xarray(ds, group, name="XR", compression="gzip"):
     """
     Embed a Xarray object into HDF5 group/dataset structure.
     To avoid attribute reading with H5coro, attributes are stored
-    as dictionary-string rather than HDF5 native attribute.
+    as JSON string (uint8 dataset) rather than HDF5 native attribute.
+    They can be read back with json.loads(bytes(array)). numpy scalars and
+    arrays are stored as numbers and lists, other values that JSON cannot
+    represent as their str().
+
+    Data arrays larger than 64 KiB are chunked and compressed with the
+    shuffle filter, so that partial reads fetch fewer bytes.
 
     Args:
         ds (xarray.core.dataset.Dataset): Xarray dataset
-        group (h5py._hl.group.Group): hdf5 group to store xarray dataset
+        group (h5py.Group): hdf5 group to store xarray dataset
+        name (str): name of the group created for the dataset
+        compression (str): HDF5 compression filter for large data arrays,
+            None to disable. gzip is the default as h5coro cannot decode lzf.
     """
 
     # Check argument type...
@@ -28,8 +38,8 @@ def embed_xarray(ds, group, name="XR"):
         "Expect " + str(xarray.core.dataset.Dataset) + "\n\t\tGet " + str(type(ds))
     )
 
-    assert isinstance(group, h5py._hl.group.Group), (
-        "Expect " + str(h5py._hl.group.Group) + "\n\t\tGet " + str(type(group))
+    assert isinstance(group, h5py.Group), (
+        "Expect " + str(h5py.Group) + "\n\t\tGet " + str(type(group))
     )
 
     xr_obj = {"data": list(ds.data_vars) + list(ds.coords), "attrs": dict(ds.attrs)}
@@ -46,25 +56,50 @@ def embed_xarray(ds, group, name="XR"):
                 xroot.create_group(_v)
 
                 # Some data may have datetime type, thus conversion is required...
-                if not np.issubdtype(ds[_v].data.dtype, np.number):
-                    xroot[_v].create_dataset(
-                        "data", data=ds[_v].data.reshape([-1]).astype("float64")
-                    )
-                else:
-                    xroot[_v].create_dataset("data", data=ds[_v].data.reshape([-1]))
-
-                _attr = ds[_v].attrs
+                _data = ds[_v].data.reshape([-1])
+                if not np.issubdtype(_data.dtype, np.number):
+                    _data = _data.astype("float64")
+
+                kwargs = {}
+                if compression and _data.nbytes > 64 * 1024:
+                    kwargs = {
+                        "chunks": True,
+                        "compression": compression,
+                        "shuffle": True,
+                    }
+                xroot[_v].create_dataset("data", data=_data, **kwargs)
+
+                _attr = dict(ds[_v].attrs)
                 _attr.update(
                     {
                         "_shape": ds[_v].data.shape,
                         "_type": "coords" if _v in list(ds.coords) else "variable",
                     }
                 )
-                xroot[_v].create_dataset(
-                    "attrs", data=np.fromstring(str(_attr), dtype="int8")
-                )
+                xroot[_v].create_dataset("attrs", data=_json_array(_attr))
 
         elif isinstance(_val, dict):
-            xroot.create_dataset(_obj, data=np.fromstring(str(_val), dtype="int8"))
+            xroot.create_dataset(_obj, data=_json_array(_val))
+
+    # The structure of the embedded group, see CloudPyASDF.utils.read_dict.
+    xroot.create_dataset("dict", data=_json_array(gen_group_dict(xroot)))
+
 
-    dump_dict(xroot, xroot, "dict")
+def _json_array(dic):
+    """
+    Helper function serializing a dictionary into a uint8 array of JSON.
+    """
+    s = json.dumps(dic, separators=(",", ":"), default=_json_default).encode()
+    return np.frombuffer(s, dtype="uint8")
+
+
+def _json_default(obj):
+    """
+    Helper function converting values that json cannot serialize. numpy
+    scalars and arrays, which are common in netCDF attributes, are
+    converted to Python numbers and lists. Anything else is stored as its
+    str().
+    """
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    return str(obj)